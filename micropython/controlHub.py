@@ -1,9 +1,10 @@
 from pybricks.hubs import InventorHub
 from pybricks.parameters import Color, Button
-from pybricks.tools import wait, StopWatch, Matrix
+from pybricks.tools import wait, StopWatch, Matrix, multitask, run_task
 
 from umath import floor
 from ustruct import unpack_from, pack, pack_into
+from uarray import array
 from urandom import randint
 
 _HUBID = const(0)
@@ -13,6 +14,20 @@ _CMD_SPEED = const(1)
 _CMD_ANGLE = const(2)
 _CMD_RESET = const(3)
 _CMD_SHUTDOWN = const(4)
+_CMD_CONFIG = const(5)
+
+_CONFIG_ALLHUBS = const(7) # parameter id: hub << 8 | index
+_CONFIG_LOOPPERIOD = const(1)
+_CONFIG_COMMANDWINDOW = const(2)
+_CONFIG_HUBTIMEOUT = const(3)
+_CONFIG_SPEEDSCALE = const(4)
+_CONFIG_SPEEDLIMIT = const(5)
+_CONFIG_ACCELERATIONLIMIT = const(6)
+_CONFIG_TORQUELIMIT = const(7)
+_CONFIG_KP = const(8)
+_CONFIG_KI = const(9)
+_CONFIG_KD = const(10)
+_CONFIG_COUNT = const(11)
 
 _CMD_SHUTDOWN_PACK = [pack('<B12h',_CMD_SHUTDOWN, 0,0,0, 0,0,0, 0,0,0, 0,0,0)]
 
@@ -20,10 +35,27 @@ _BUTTON_IDLE = const(0)
 _BUTTON_ACTIVE = const(1)
 _BUTTON_SELECT = const(2)
 _BUTTON_INACTIVE = const(3)
+_LIGHT_PERIOD = const(10) # ms per light step, button menu windows and blink cycle in steps
 
 _SELECT_RETURN = const(7)
 _SELECT_SHUTDOWN = const(8)
 
+_RECORDER_SIZE = const(32) # bytes per entry: kind, length, time, payload
+_RECORDER_COUNT = const(128)
+_RECORDER_LOOPCOUNT = const(256)
+_RECORDER_PERIOD = const(100) # ms between loop time entries
+_RECORDER_DUMPLINES = const(4)
+_RECORD_COMMAND = const(2)
+
+_RELAY = const(0) # 1 -> relay combined hub state on the broadcast channel between commands
+_RELAY_PERIOD = const(200)
+_RELAY_DURATION = const(40)
+_RELAY_STATUS = const(0)
+_RELAY_ANGLES = const(1)
+_RELAY_ACCELERATION = const(2)
+
+_OBSERVE_ACKPERIOD = const(4) # loops between observing hubs that acknowledged the current command
+
 _LEDICONS = [
 Matrix(
     [
@@ -111,9 +143,27 @@ loopCounter = 0
 commandCounter = 0
 buttonMode = _BUTTON_IDLE
 selection = _SELECT_RETURN
+pendingBroadcast = 0
 hubSensorData = [0, 0, 0, 0, 0, 0, 0]
 hubTimestamps = [StopWatch(), StopWatch(), StopWatch(), StopWatch(), StopWatch(), StopWatch(), StopWatch()]
 hubChecksums = [0, 0, 0, 0, 0, 0, 0]
+hubReceived = [0, 0, 0, 0, 0, 0, 0]
+hubAccepted = [False, False, False, False, False, False, False]
+observeCounter = 0
+config = [0, 0, 100, 10000, 2, None, None, None, None, None, None] # None -> firmware default
+recorderBuffer = bytearray(_RECORDER_SIZE*_RECORDER_COUNT)
+recorderIndex = 0
+recorderLoopTimes = array('h', [0]*_RECORDER_LOOPCOUNT)
+recorderLoopIndex = 0
+recorderDumped = True
+hubStatus = 0
+recorderTimestamp = StopWatch()
+loopTimestamp = StopWatch()
+recorderLoopTimestamp = StopWatch()
+recorderLoopMax = 0
+recorderDump = 0
+recorderDumpLine = 0
+relayIndex = _RELAY_STATUS
 
 
 hub = InventorHub(observe_channels=[0,1,2,3,4,5,6], broadcast_channel=_HUBID)
@@ -121,6 +171,72 @@ hub.system.set_stop_button(None)
 hub.speaker.volume(10)
 
 
+def recordEntry(kind, data):
+    global recorderIndex
+    offset = _RECORDER_SIZE*recorderIndex
+    length = min(len(data), _RECORDER_SIZE - 4)
+    pack_into('<BBH', recorderBuffer, offset, kind, length, recorderTimestamp.time() & 0xffff)
+    for i in range(length):
+        recorderBuffer[offset + 4 + i] = data[i]
+    recorderIndex = (recorderIndex + 1) % _RECORDER_COUNT
+
+
+def recordLoopTime():
+    # longest loop time within each recorder period
+    global recorderLoopIndex, recorderLoopMax
+    recorderLoopMax = max(recorderLoopMax, loopTimestamp.time())
+    loopTimestamp.reset()
+    if recorderLoopTimestamp.time() >= _RECORDER_PERIOD:
+        recorderLoopTimestamp.reset()
+        recorderLoopTimes[recorderLoopIndex] = min(recorderLoopMax, 32767)
+        recorderLoopMax = 0
+        recorderLoopIndex = (recorderLoopIndex + 1) % _RECORDER_LOOPCOUNT
+
+
+def dumpRecorder():
+    # copy the recorder, printRecorder sends it a few lines per pass
+    global recorderDump, recorderDumpLine, recorderDumped
+    recorderDump = [bytes(recorderBuffer), recorderIndex, array('h', recorderLoopTimes), recorderLoopIndex]
+    recorderDumpLine = 0
+    recorderDumped = True
+    print("recorder", _HUBID, recorderTimestamp.time() & 0xffff)
+
+
+def printRecorder():
+    # oldest entry first, one hex line per entry
+    global recorderDump, recorderDumpLine
+    if not recorderDump:
+        return
+    [entries, index, loopTimes, loopIndex] = recorderDump
+    for n in range(_RECORDER_DUMPLINES):
+        if recorderDumpLine == _RECORDER_COUNT:
+            print("looptimes", *[loopTimes[(loopIndex + i) % _RECORDER_LOOPCOUNT] for i in range(_RECORDER_LOOPCOUNT)])
+            recorderDump = 0
+            return
+        offset = _RECORDER_SIZE*((index + recorderDumpLine) % _RECORDER_COUNT)
+        if entries[offset]:
+            print("".join("{:02x}".format(b) for b in entries[offset:offset + 4 + entries[offset + 1]]))
+        recorderDumpLine += 1
+
+
+def checkRecorder():
+    # dump once when a hub times out, status from the last light step
+    global recorderDumped
+    if hubStatus & 0b00100000:
+        recorderDumped = False
+    elif not recorderDumped and not recorderDump:
+        dumpRecorder()
+
+
+def setConfig(data):
+    global config
+    for i in range(6):
+        param, value = unpack_from('<hh', data, 1 + 4*i)
+        if (param >> 8) in (_HUBID, _CONFIG_ALLHUBS) and (param & 0xff) > 0 and (param & 0xff) < _CONFIG_COUNT:
+            config[param & 0xff] = value
+    #print("config is", config)
+
+
 def getSpeedCmd(speed, counter):
     buffer = bytearray(pack('<B12h',_CMD_SPEED, 0,0,0, 0,0,0, 0,0,0, 0,0,0))
     pack_into('<h', buffer, 1 + 2*counter, speed)
@@ -133,15 +249,15 @@ def getStatus():
         status += 1
     status += 32
     for i in range(1, 7):
-        if(hubTimestamps[i].time() > 10000):
+        if(hubTimestamps[i].time() > config[_CONFIG_HUBTIMEOUT]):
             status -= 32
             break
     if(buttonMode):
         status += 64
     return status
 
-def executeCommand(data):
-    global hubTimestamps, hubSensorData, hubChecksums
+async def executeCommand(data):
+    global hubTimestamps, hubSensorData, hubChecksums, hubReceived, hubAccepted
     checksum = 0
     try:
         cmd = unpack_from('<B', data[0], 0)[0]
@@ -151,24 +267,41 @@ def executeCommand(data):
         #print("failed to unpack", data)
         return
     hubTimestamps[0].reset()
+    if not hubSensorData[0] or data[0] != hubSensorData[0][0]:
+        recordEntry(_RECORD_COMMAND, data[0])
+        # process unchanged hub data again for the new command
+        hubReceived = [0, 0, 0, 0, 0, 0, 0]
+        hubAccepted = [False, False, False, False, False, False, False]
     hubSensorData[0] = data
     hubChecksums[0] = checksum
-    if cmd == _CMD_SHUTDOWN:
-        hub.speaker.beep(1000, 20)
-        wait(100)
-        hub.speaker.beep(1000, 20)
-        wait(100)
-        hub.speaker.beep(1000, 20)
-        wait(100)
-        hub.speaker.beep(1000, 20)
-        wait(100)
+    if cmd == _CMD_CONFIG:
+        setConfig(data[0])
+    elif cmd == _CMD_SHUTDOWN:
+        await hub.speaker.beep(1000, 20)
+        await wait(100)
+        await hub.speaker.beep(1000, 20)
+        await wait(100)
+        await hub.speaker.beep(1000, 20)
+        await wait(100)
+        await hub.speaker.beep(1000, 20)
+        await wait(100)
         hub.system.shutdown()
 
-def getSensorData():
-    global hubSensorData, hubTimestamps, hubChecksums, commandCounter
+async def getSensorData():
+    global hubSensorData, hubTimestamps, hubChecksums, hubReceived, hubAccepted, commandCounter, observeCounter
+    observeCounter = (observeCounter + 1) % _OBSERVE_ACKPERIOD
     for i in range(1, 7):
+        if observeCounter and hubAccepted[i] and hubChecksums[i] == hubChecksums[0]:
+            continue
         receive = hub.ble.observe(i)
         if receive:
+            if receive[0] == hubReceived[i]:
+                # same advertisement as before, only keep the hub alive
+                if hubAccepted[i]:
+                    hubTimestamps[i].reset()
+                continue
+            hubReceived[i] = receive[0]
+            hubAccepted[i] = False
             hubSensorData[i] = receive[0]
             try:
                 status = receive[0][0]
@@ -179,28 +312,30 @@ def getSensorData():
             #print("receive", i, hubSensorData[i], status)
             if hubChecksums[i] == hubChecksums[0]:
                 if (i <= 4 and (status & 0b00110011 == 0b00100011)) or (i > 4 and (status & 0b00111111 == 0b00111111)):
+                    hubAccepted[i] = True
                     hubTimestamps[i].reset()
                     if all(hubChecksums[i] == hubChecksums[0] for i in range(6)):
                         commandCounter += 1
                         command = [pack('<B12h',_CMD_KEEPALIVE, commandCounter,0,0, 0,0,0, 0,0,0, 0,0,0)]
                         #print("all checksums", hubChecksums[i])
-                        sendCommand(command)
+                        await sendCommand(command)
 
 
 
-def getCommand():
+async def getCommand():
     global buttonMode, selection, loopCounter
     #print("button mode is", buttonMode, selection)
     if buttonMode == _BUTTON_IDLE:
         if hub.buttons.pressed() == {Button.CENTER}:
-            sendCommand(getSpeedCmd(0, 0))
-            hub.speaker.beep(1000, 20)
+            await sendCommand(getSpeedCmd(0, 0))
+            await hub.speaker.beep(1000, 20)
+            dumpRecorder()
             buttonMode = _BUTTON_ACTIVE
             selection = _SELECT_RETURN
         else:
             receive = hub.ble.observe(0)
             if receive:
-                executeCommand(receive)
+                await executeCommand(receive)
     elif buttonMode == _BUTTON_ACTIVE:
         if hub.buttons.pressed():
             loopCounter = 0
@@ -214,7 +349,7 @@ def getCommand():
     elif buttonMode == _BUTTON_SELECT:
         if hub.buttons.pressed() == {Button.CENTER}:
             if selection == _SELECT_SHUTDOWN:
-                sendCommand(_CMD_SHUTDOWN_PACK)
+                await sendCommand(_CMD_SHUTDOWN_PACK)
             buttonMode = _BUTTON_INACTIVE
         elif hub.buttons.pressed() == {Button.LEFT}:
             if(selection > 0):
@@ -237,7 +372,7 @@ def getCommand():
                 elif(roll > 15):
                     motor = 0
                 command = getSpeedCmd(pitch*30, motor + 3*(selection - 1))
-                sendCommand(command)
+                await sendCommand(command)
             elif(selection > 4 and selection < 7):
                 motor = 0
                 if(roll < -20):
@@ -249,13 +384,14 @@ def getCommand():
                 else:
                     motor = 4
                 command = getSpeedCmd(pitch*30, motor + 6*(selection - 5))
-                sendCommand(command)
+                await sendCommand(command)
 
 
 
 def setLedColor():
-    global loopCounter
+    global loopCounter, hubStatus
     status = getStatus()
+    hubStatus = status
     h = 0
     s = 100
     v = 0
@@ -269,7 +405,7 @@ def setLedColor():
         h = 160
         matrix += _LEDICONS[0]
         for i in range(1, 7):
-            if hubTimestamps[i].time() < 10000:
+            if hubTimestamps[i].time() < config[_CONFIG_HUBTIMEOUT]:
                 matrix += _LEDICONS[i]
     elif(status & 0b01000000 == 0b01000000): #selected
         if loopCounter < 250:
@@ -305,14 +441,137 @@ def setLedColor():
 
 
 
-def sendCommand(command):
-    hub.ble.broadcast(command)
-    executeCommand(command)
+def getRelayValue(i, offset):
+    try:
+        return unpack_from('<h', hubSensorData[i], offset)[0]
+    except:
+        return 0
+
+
+def isFusedFrame(i):
+    return isinstance(hubSensorData[i], bytes) and len(hubSensorData[i]) == 15
+
+
+def isPackedFrame(i):
+    # bit packed frame version 2, 17 bytes from leg hubs, 25 bytes from middle hubs
+    return isinstance(hubSensorData[i], bytes) and len(hubSensorData[i]) in (17, 25) and hubSensorData[i][2] & 0x0f == 2
+
+
+def unpackBits(data, offset, width):
+    # signed little endian bit field
+    value = 0
+    shift = 0
+    while shift < width:
+        n = min(8 - (offset & 7), width - shift)
+        value |= ((data[offset >> 3] >> (offset & 7)) & ((1 << n) - 1)) << shift
+        offset += n
+        shift += n
+    if value & (1 << (width - 1)):
+        value -= 1 << width
+    return value
+
+
+def getLegAngle(i):
+    # motor angle in 0.1 degree as in frame version 1
+    if isPackedFrame(i):
+        return floor(0.1*unpackBits(hubSensorData[i], 56, 20))
+    return getRelayValue(i, 11 if isFusedFrame(i) else 8)
+
+
+def getMiddleAngle(i, j):
+    # motor angle in 0.1 degree as in frame version 1
+    if isPackedFrame(i):
+        angle = unpackBits(hubSensorData[i], 56, 20)
+        if j > 0:
+            angle += unpackBits(hubSensorData[i], 58 + 18*j, 18)
+        return floor(0.1*angle)
+    return getRelayValue(i, 8 + 2*j)
+
+
+def getMiddleAcceleration(i, j):
+    if isPackedFrame(i):
+        return 5*unpackBits(hubSensorData[i], 20 + 12*j, 12)
+    return getRelayValue(i, 2 + 2*j)
+
+
+def getRelayFrame():
+    # 18 bytes like the leg hub frame, so hubs reject it as command
+    global relayIndex
+    if relayIndex == _RELAY_STATUS:
+        ackmask = 0
+        statuses = [0, 0, 0, 0, 0, 0]
+        legAngles = [0, 0, 0, 0]
+        for i in range(1, 7):
+            if hubChecksums[i] == hubChecksums[0]:
+                ackmask += 2**(i-1)
+            try:
+                statuses[i-1] = hubSensorData[i][0]
+            except:
+                pass
+        for i in range(1, 5):
+            legAngles[i-1] = getLegAngle(i)
+        data = pack('<BBBB6B4h', relayIndex, hubChecksums[0], ackmask, getStatus(), *statuses, *legAngles)
+    elif relayIndex == _RELAY_ANGLES:
+        middleAngles = [getMiddleAngle(5 + j//4, j%4) for j in range(8)]
+        data = pack('<BB8h', relayIndex, hubChecksums[0], *middleAngles)
+    else:
+        imuV = [getMiddleAcceleration(5, j) for j in range(3)]
+        data = pack('<BB8h', relayIndex, hubChecksums[0], *imuV, 0, 0, 0, 0, 0)
+    relayIndex = (relayIndex + 1) % 3
+    return data
+
+
+async def sendCommand(command):
+    global pendingBroadcast
+    pendingBroadcast = command # sent by broadcastTask
+    await executeCommand(command)
+
+
+async def commandTask():
+    while(True):
+        await getCommand()
+        checkRecorder()
+        printRecorder()
+        await wait(0)
+
+
+async def sensorTask():
+    while(True):
+        recordLoopTime()
+        await getSensorData()
+        await wait(config[_CONFIG_LOOPPERIOD])
+
+
+async def broadcastTask():
+    # only task using hub.ble.broadcast, sends the latest pending command
+    # and with _RELAY the combined hub state between commands
+    global pendingBroadcast
+    lastBroadcast = 0
+    relayTimestamp = StopWatch()
+    while(True):
+        if pendingBroadcast:
+            lastBroadcast = pendingBroadcast
+            pendingBroadcast = 0
+            await hub.ble.broadcast(lastBroadcast)
+        elif _RELAY and lastBroadcast and relayTimestamp.time() > _RELAY_PERIOD:
+            relayTimestamp.reset()
+            await hub.ble.broadcast([getRelayFrame()])
+            await wait(_RELAY_DURATION)
+            if not pendingBroadcast:
+                await hub.ble.broadcast(lastBroadcast)
+        await wait(0)
+
+
+async def lightTask():
+    while(True):
+        setLedColor()
+        await wait(_LIGHT_PERIOD)
+
+
+async def main():
+    command = [pack('<B12h',_CMD_KEEPALIVE, commandCounter,0,0, 0,0,0, 0,0,0, 0,0,0)]
+    await sendCommand(command)
+    await multitask(commandTask(), sensorTask(), broadcastTask(), lightTask())
 
 
-command = [pack('<B12h',_CMD_KEEPALIVE, commandCounter,0,0, 0,0,0, 0,0,0, 0,0,0)]
-sendCommand(command)
-while(True):
-    getCommand()
-    getSensorData()
-    setLedColor()
+run_task(main())
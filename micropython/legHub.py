@@ -1,22 +1,41 @@
 from pybricks.hubs import TechnicHub
 from pybricks.pupdevices import Motor, ColorDistanceSensor
 from pybricks.parameters import Color, Port, Button, Axis
-from pybricks.tools import StopWatch
+from pybricks.tools import StopWatch, wait, multitask, run_task
 from pybricks.iodevices import PUPDevice
 from ustruct import unpack_from, pack, pack_into
-from umath import floor, sqrt
+from uarray import array
+from umath import floor, sqrt, atan2
 
 
 _HUBID = const(1)
 _MOTORPORT = Port.A
 _TILTPORT = Port.B
 _DISTANCEPORT = Port.C
+_SENSORFUSION = const(0) # 1 -> broadcast leg angles instead of acceleration vectors
+_ANGLESCALE = const(10000) # fixed point leg angles in 1e-4 rad
+_TILTGRAVITY = 45*sqrt(2) # tilt sensor reading of 1g
+_FRAMEVERSION = const(2) # 1 -> '<BB8h' frame with 0.1 degree angle, 2 -> bit packed frame with speed and load
 
 _CMD_KEEPALIVE = const(0)
 _CMD_SPEED = const(1)
 _CMD_ANGLE = const(2)
 _CMD_RESET = const(3)
 _CMD_SHUTDOWN = const(4)
+_CMD_CONFIG = const(5)
+
+_CONFIG_ALLHUBS = const(7) # parameter id: hub << 8 | index
+_CONFIG_LOOPPERIOD = const(1)
+_CONFIG_COMMANDWINDOW = const(2)
+_CONFIG_HUBTIMEOUT = const(3)
+_CONFIG_SPEEDSCALE = const(4)
+_CONFIG_SPEEDLIMIT = const(5)
+_CONFIG_ACCELERATIONLIMIT = const(6)
+_CONFIG_TORQUELIMIT = const(7)
+_CONFIG_KP = const(8)
+_CONFIG_KI = const(9)
+_CONFIG_KD = const(10)
+_CONFIG_COUNT = const(11)
 
 _CMD_SHUTDOWN_PACK = [pack('<B12h',_CMD_SHUTDOWN, 0,0,0, 0,0,0, 0,0,0, 0,0,0)]
 
@@ -24,6 +43,16 @@ _BUTTON_IDLE = const(0)
 _BUTTON_ACTIVE = const(1)
 _BUTTON_SELECT = const(2)
 _BUTTON_INACTIVE = const(3)
+_LIGHT_PERIOD = const(10) # ms per light step, button menu windows and blink cycle in steps
+
+_RECORDER_SIZE = const(32) # bytes per entry: kind, length, time, payload
+_RECORDER_COUNT = const(128)
+_RECORDER_LOOPCOUNT = const(256)
+_RECORDER_TIMEOUT = const(1000)
+_RECORDER_PERIOD = const(100) # ms between frame and loop time entries
+_RECORDER_DUMPLINES = const(4)
+_RECORD_FRAME = const(1)
+_RECORD_COMMAND = const(2)
 
 
 loopCounter = 0
@@ -35,10 +64,25 @@ motor = 0
 tiltSensor = 0
 distanceSensor = 0
 angle = 0
+speed = 0
+load = 0
 imuA = [0, 0, 0]
 tiltA = [0, 0, 0]
 distance = 0
 status = 0
+config = [0, 0, 100, 10000, 2, None, None, None, None, None, None] # None -> firmware default
+recorderBuffer = bytearray(_RECORDER_SIZE*_RECORDER_COUNT)
+recorderIndex = 0
+recorderLoopTimes = array('h', [0]*_RECORDER_LOOPCOUNT)
+recorderLoopIndex = 0
+recorderDumped = True
+recorderTimestamp = StopWatch()
+loopTimestamp = StopWatch()
+recorderLoopTimestamp = StopWatch()
+recorderLoopMax = 0
+recorderDump = 0
+recorderDumpLine = 0
+recorderFrameTimestamp = StopWatch()
 
 hub = TechnicHub(observe_channels=[0], broadcast_channel=_HUBID)
 hub.system.set_stop_button(None)
@@ -79,18 +123,105 @@ class TiltSensor(PUPDevice):
         return [self.__x_post[0], self.__y_post[0], self.__z_post[0]]
 
 
+def recordEntry(kind, data):
+    global recorderIndex
+    offset = _RECORDER_SIZE*recorderIndex
+    length = min(len(data), _RECORDER_SIZE - 4)
+    pack_into('<BBH', recorderBuffer, offset, kind, length, recorderTimestamp.time() & 0xffff)
+    for i in range(length):
+        recorderBuffer[offset + 4 + i] = data[i]
+    recorderIndex = (recorderIndex + 1) % _RECORDER_COUNT
+
+
+def recordFrame(data):
+    # at most one frame per recorder period
+    if recorderFrameTimestamp.time() >= _RECORDER_PERIOD:
+        recorderFrameTimestamp.reset()
+        recordEntry(_RECORD_FRAME, data)
+
+
+def recordLoopTime():
+    # longest loop time within each recorder period
+    global recorderLoopIndex, recorderLoopMax
+    recorderLoopMax = max(recorderLoopMax, loopTimestamp.time())
+    loopTimestamp.reset()
+    if recorderLoopTimestamp.time() >= _RECORDER_PERIOD:
+        recorderLoopTimestamp.reset()
+        recorderLoopTimes[recorderLoopIndex] = min(recorderLoopMax, 32767)
+        recorderLoopMax = 0
+        recorderLoopIndex = (recorderLoopIndex + 1) % _RECORDER_LOOPCOUNT
+
+
+def dumpRecorder():
+    # copy the recorder, printRecorder sends it a few lines per pass
+    global recorderDump, recorderDumpLine, recorderDumped
+    recorderDump = [bytes(recorderBuffer), recorderIndex, array('h', recorderLoopTimes), recorderLoopIndex]
+    recorderDumpLine = 0
+    recorderDumped = True
+    print("recorder", _HUBID, recorderTimestamp.time() & 0xffff)
+
+
+def printRecorder():
+    # oldest entry first, one hex line per entry
+    global recorderDump, recorderDumpLine
+    if not recorderDump:
+        return
+    [entries, index, loopTimes, loopIndex] = recorderDump
+    for n in range(_RECORDER_DUMPLINES):
+        if recorderDumpLine == _RECORDER_COUNT:
+            print("looptimes", *[loopTimes[(loopIndex + i) % _RECORDER_LOOPCOUNT] for i in range(_RECORDER_LOOPCOUNT)])
+            recorderDump = 0
+            return
+        offset = _RECORDER_SIZE*((index + recorderDumpLine) % _RECORDER_COUNT)
+        if entries[offset]:
+            print("".join("{:02x}".format(b) for b in entries[offset:offset + 4 + entries[offset + 1]]))
+        recorderDumpLine += 1
+
+
+def checkRecorder():
+    # no commands are observed while the button menu is active
+    if buttonMode != _BUTTON_IDLE or recorderDump:
+        return
+    if not recorderDumped and commandTimestamp.time() > _RECORDER_TIMEOUT:
+        dumpRecorder()
+
+
 def getSpeedCmd(speed):
     buffer = bytearray(pack('<B12h',_CMD_SPEED, 0,0,0, 0,0,0, 0,0,0, 0,0,0))
     pack_into('<h', buffer, 5 + 6*(_HUBID - 1), speed)
     return [buffer]
 
 
+def setConfig(data):
+    # returns True if a motor parameter was set
+    global config
+    isMotorConfig = False
+    for i in range(6):
+        param, value = unpack_from('<hh', data, 1 + 4*i)
+        if (param >> 8) in (_HUBID, _CONFIG_ALLHUBS) and (param & 0xff) > 0 and (param & 0xff) < _CONFIG_COUNT:
+            config[param & 0xff] = value
+            if (param & 0xff) >= _CONFIG_SPEEDLIMIT:
+                isMotorConfig = True
+    #print("config is", config)
+    return isMotorConfig
+
+
+def setMotorConfig(m):
+    try:
+        m.control.limits(config[_CONFIG_SPEEDLIMIT], config[_CONFIG_ACCELERATIONLIMIT], config[_CONFIG_TORQUELIMIT])
+        m.control.pid(config[_CONFIG_KP], config[_CONFIG_KI], config[_CONFIG_KD])
+    except:
+        #print("failed to configure motor", m)
+        pass
+
+
 def getMotor(port):
     global motor
     if motor:
         motor.close()
     try:
         motor = Motor(port, reset_angle=False)
+        setMotorConfig(motor)
         #print("motor found")
     except:
         motor = 0
@@ -128,14 +259,14 @@ def getStatus():
         status += 4
     if(distanceSensor):
         status += 8
-    if(commandTimestamp.time() < 100):
+    if(commandTimestamp.time() < config[_CONFIG_COMMANDWINDOW]):
         status += 32
     if(buttonMode):
         status += 64
 
 
 def executeCommand(data):
-    global motor, currentCommand, currentChecksum, commandTimestamp
+    global recorderDumped, motor, currentCommand, currentChecksum, commandTimestamp
     checksum = 0
     try:
         command = unpack_from('<B', data[0], 0)[0]
@@ -146,6 +277,10 @@ def executeCommand(data):
         #print("failed to unpack", data)
         return
     commandTimestamp.reset()
+    isNewCommand = not currentCommand or data[0] != currentCommand[0]
+    if isNewCommand:
+        recordEntry(_RECORD_COMMAND, data[0])
+    recorderDumped = False
     currentCommand = data
     currentChecksum = checksum
     #print("command", cmd, bottom)
@@ -171,14 +306,22 @@ def executeCommand(data):
             getMotor(_MOTORPORT)
     elif command == _CMD_SHUTDOWN:
         hub.system.shutdown()
+    elif command == _CMD_CONFIG and isNewCommand and setConfig(data[0]):
+        try:
+            motor.brake() # limits can only change while the controller is inactive
+            setMotorConfig(motor)
+        except:
+            getMotor(_MOTORPORT)
 
 
 def getSensorValues():
-    global motor, tiltSensor, distanceSensor, angle, imuA, tiltA, distance
+    global motor, tiltSensor, distanceSensor, angle, speed, load, imuA, tiltA, distance
     imuA = list(Axis.Z.T*hub.imu.orientation())
 
     try:
         angle = motor.angle()
+        speed = motor.speed()
+        load = motor.load()
         #print("angle is", angle)
     except:
         getMotor(_MOTORPORT)
@@ -188,16 +331,7 @@ def getSensorValues():
     except:
         getTiltSensor(_TILTPORT)
     try:
-        if (status & 0b01000000 == 0b01000000): #selected
-            if loopCounter == 0:
-                distanceSensor.light.on(Color.RED)
-            elif loopCounter == 250:
-                distanceSensor.light.on(Color.GREEN)
-            elif loopCounter == 500:
-                distanceSensor.light.on(Color.BLUE)
-            elif loopCounter == 750:
-                distanceSensor.light.off()
-        else:
+        if (status & 0b01000000 == 0b00000000): # not selected
             distance = distanceSensor.distance()
             #print("distance is", distance)
     except:
@@ -210,6 +344,7 @@ def getCommand():
     if buttonMode == _BUTTON_IDLE:
         if hub.button.pressed():
             executeCommand(getSpeedCmd(0))
+            dumpRecorder()
             buttonMode = _BUTTON_ACTIVE
         else:
             receive = hub.ble.observe(0)
@@ -273,23 +408,109 @@ def setLedColor():
     elif(status & 0b01000000 == 0b00000000): # not selected
         v = 20 + 2e-4*(500 - loopCounter)**2
     hub.light.on(Color(h, s, v))
+    if(status & 0b01000000 == 0b01000000): # selected
+        setDistanceLight()
     loopCounter = (loopCounter + 1) % 1000
 
 
-def transmitSensorValues():
-    imuV = [0, 0, 0]
-    tiltV = [0, 0, 0]
-    for j in range(3):
-        tiltV[j] = floor(154.0966*tiltA[j])
-        imuV[j] = floor(9806.65*imuA[j])
-    data = pack('<BB8h', status, currentChecksum, *imuV, floor(0.1*angle), *tiltV, distance)
+def setDistanceLight():
+    # selection colour on the distance sensor, every light step so no window is skipped
+    try:
+        if loopCounter == 0:
+            distanceSensor.light.on(Color.RED)
+        elif loopCounter == 250:
+            distanceSensor.light.on(Color.GREEN)
+        elif loopCounter == 500:
+            distanceSensor.light.on(Color.BLUE)
+        elif loopCounter == 750:
+            distanceSensor.light.off()
+    except:
+        getDistanceSensor(_DISTANCEPORT)
+
+
+def getLegAngles():
+    # inclination of upper and lower leg with respect to gravity, host axes: [-x, z, -y] and [y, x, z]
+    [x, y, z] = imuA
+    mountV = floor(_ANGLESCALE*atan2(z, sqrt(x**2 + y**2)))
+    topV = floor(_ANGLESCALE*atan2(-y, -x))
+    bottomV = floor(_ANGLESCALE*atan2(tiltA[2], tiltA[1]))
+    bottomElevationV = floor(_ANGLESCALE*atan2(tiltA[0], sqrt(tiltA[1]**2 + tiltA[2]**2)))
+    confidence = 0
+    if(tiltSensor):
+        # confidence of the lower leg angles, deviation of the tilt sensor from 1g indicates leg movement or impact
+        norm = sqrt(tiltA[0]**2 + tiltA[1]**2 + tiltA[2]**2)
+        confidence = max(0, 255 - floor(255*abs(norm - _TILTGRAVITY)/_TILTGRAVITY))
+        if(not hub.imu.stationary()):
+            confidence >>= 1
+    return [mountV, topV, bottomV, bottomElevationV, confidence]
+
+
+def packBits(buffer, offset, width, value):
+    # signed little endian bit field, saturated to width
+    limit = 1 << (width - 1)
+    value = min(max(value, -limit), limit - 1) & (2*limit - 1)
+    while width > 0:
+        shift = offset & 7
+        n = min(8 - shift, width)
+        buffer[offset >> 3] |= (value & ((1 << n) - 1)) << shift
+        value >>= n
+        offset += n
+        width -= n
+    return offset
+
+
+async def transmitSensorValues():
+    if _SENSORFUSION:
+        data = pack('<BB4hBhh', status, currentChecksum, *getLegAngles(), floor(0.1*angle), distance)
+    elif _FRAMEVERSION == 2:
+        # status, checksum, then bits: version 4, imu 3x12 (5 mm/s^2), angle 20 (degree),
+        # speed 8 (8 degree/s), load 8 (4 mNm), tilt 3x12 (5 mm/s^2), distance 8
+        buffer = bytearray(17)
+        buffer[0] = status
+        buffer[1] = currentChecksum
+        offset = packBits(buffer, 16, 4, _FRAMEVERSION)
+        for j in range(3):
+            offset = packBits(buffer, offset, 12, floor(1961.33*imuA[j]))
+        offset = packBits(buffer, offset, 20, angle)
+        offset = packBits(buffer, offset, 8, speed >> 3)
+        offset = packBits(buffer, offset, 8, load >> 2)
+        for j in range(3):
+            offset = packBits(buffer, offset, 12, floor(30.81932*tiltA[j]))
+        packBits(buffer, offset, 8, distance)
+        data = bytes(buffer)
+    else:
+        imuV = [0, 0, 0]
+        tiltV = [0, 0, 0]
+        for j in range(3):
+            tiltV[j] = floor(154.0966*tiltA[j])
+            imuV[j] = floor(9806.65*imuA[j])
+        data = pack('<BB8h', status, currentChecksum, *imuV, floor(0.1*angle), *tiltV, distance)
     #print("data is", data)
-    hub.ble.broadcast([data])
+    recordFrame(data)
+    await hub.ble.broadcast([data])
+
+
+async def commandTask():
+    while(True):
+        getCommand()
+        checkRecorder()
+        printRecorder()
+        await wait(0)
+
+
+async def sensorTask():
+    while(True):
+        recordLoopTime()
+        getSensorValues()
+        getStatus()
+        await transmitSensorValues()
+        await wait(config[_CONFIG_LOOPPERIOD])
+
+
+async def lightTask():
+    while(True):
+        setLedColor()
+        await wait(_LIGHT_PERIOD)
 
 
-while(True):
-    getCommand()
-    getSensorValues()
-    getStatus()
-    setLedColor()
-    transmitSensorValues()
+run_task(multitask(commandTask(), sensorTask(), lightTask()))
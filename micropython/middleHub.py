@@ -1,20 +1,36 @@
 from pybricks.hubs import TechnicHub
 from pybricks.pupdevices import Motor
 from pybricks.parameters import Color, Port, Button, Axis
-from pybricks.tools import StopWatch
+from pybricks.tools import StopWatch, wait, multitask, run_task
 
 from ustruct import unpack_from, pack, pack_into
+from uarray import array
 from umath import floor
 
 
 _HUBID = const(5)
 _MOTORPORTS = [Port.B, Port.D, Port.A, Port.C]
+_FRAMEVERSION = const(2) # 1 -> '<BB7h' frame with 0.1 degree angles, 2 -> bit packed frame with speeds and loads
 
 _CMD_KEEPALIVE = const(0)
 _CMD_SPEED = const(1)
 _CMD_ANGLE = const(2)
 _CMD_RESET = const(3)
 _CMD_SHUTDOWN = const(4)
+_CMD_CONFIG = const(5)
+
+_CONFIG_ALLHUBS = const(7) # parameter id: hub << 8 | index
+_CONFIG_LOOPPERIOD = const(1)
+_CONFIG_COMMANDWINDOW = const(2)
+_CONFIG_HUBTIMEOUT = const(3)
+_CONFIG_SPEEDSCALE = const(4)
+_CONFIG_SPEEDLIMIT = const(5)
+_CONFIG_ACCELERATIONLIMIT = const(6)
+_CONFIG_TORQUELIMIT = const(7)
+_CONFIG_KP = const(8)
+_CONFIG_KI = const(9)
+_CONFIG_KD = const(10)
+_CONFIG_COUNT = const(11)
 
 _CMD_SHUTDOWN_PACK = [pack('<B12h',_CMD_SHUTDOWN, 0,0,0, 0,0,0, 0,0,0, 0,0,0)]
 
@@ -22,6 +38,16 @@ _BUTTON_IDLE = const(0)
 _BUTTON_ACTIVE = const(1)
 _BUTTON_SELECT = const(2)
 _BUTTON_INACTIVE = const(3)
+_LIGHT_PERIOD = const(10) # ms per light step, button menu windows and blink cycle in steps
+
+_RECORDER_SIZE = const(32) # bytes per entry: kind, length, time, payload
+_RECORDER_COUNT = const(128)
+_RECORDER_LOOPCOUNT = const(256)
+_RECORDER_TIMEOUT = const(1000)
+_RECORDER_PERIOD = const(100) # ms between frame and loop time entries
+_RECORDER_DUMPLINES = const(4)
+_RECORD_FRAME = const(1)
+_RECORD_COMMAND = const(2)
 
 
 loopCounter = 0
@@ -32,18 +58,119 @@ commandTimestamp = StopWatch()
 motors = [0, 0, 0, 0]
 imuA = [0.0, 0.0, 0.0]
 angles = [0, 0, 0, 0]
+speeds = [0, 0, 0, 0]
+loads = [0, 0, 0, 0]
 status = 0
+config = [0, 0, 100, 10000, 2, None, None, None, None, None, None] # None -> firmware default
+recorderBuffer = bytearray(_RECORDER_SIZE*_RECORDER_COUNT)
+recorderIndex = 0
+recorderLoopTimes = array('h', [0]*_RECORDER_LOOPCOUNT)
+recorderLoopIndex = 0
+recorderDumped = True
+recorderTimestamp = StopWatch()
+loopTimestamp = StopWatch()
+recorderLoopTimestamp = StopWatch()
+recorderLoopMax = 0
+recorderDump = 0
+recorderDumpLine = 0
+recorderFrameTimestamp = StopWatch()
 
 hub = TechnicHub(observe_channels=[0], broadcast_channel=_HUBID)
 hub.system.set_stop_button(None)
 
 
+def recordEntry(kind, data):
+    global recorderIndex
+    offset = _RECORDER_SIZE*recorderIndex
+    length = min(len(data), _RECORDER_SIZE - 4)
+    pack_into('<BBH', recorderBuffer, offset, kind, length, recorderTimestamp.time() & 0xffff)
+    for i in range(length):
+        recorderBuffer[offset + 4 + i] = data[i]
+    recorderIndex = (recorderIndex + 1) % _RECORDER_COUNT
+
+
+def recordFrame(data):
+    # at most one frame per recorder period
+    if recorderFrameTimestamp.time() >= _RECORDER_PERIOD:
+        recorderFrameTimestamp.reset()
+        recordEntry(_RECORD_FRAME, data)
+
+
+def recordLoopTime():
+    # longest loop time within each recorder period
+    global recorderLoopIndex, recorderLoopMax
+    recorderLoopMax = max(recorderLoopMax, loopTimestamp.time())
+    loopTimestamp.reset()
+    if recorderLoopTimestamp.time() >= _RECORDER_PERIOD:
+        recorderLoopTimestamp.reset()
+        recorderLoopTimes[recorderLoopIndex] = min(recorderLoopMax, 32767)
+        recorderLoopMax = 0
+        recorderLoopIndex = (recorderLoopIndex + 1) % _RECORDER_LOOPCOUNT
+
+
+def dumpRecorder():
+    # copy the recorder, printRecorder sends it a few lines per pass
+    global recorderDump, recorderDumpLine, recorderDumped
+    recorderDump = [bytes(recorderBuffer), recorderIndex, array('h', recorderLoopTimes), recorderLoopIndex]
+    recorderDumpLine = 0
+    recorderDumped = True
+    print("recorder", _HUBID, recorderTimestamp.time() & 0xffff)
+
+
+def printRecorder():
+    # oldest entry first, one hex line per entry
+    global recorderDump, recorderDumpLine
+    if not recorderDump:
+        return
+    [entries, index, loopTimes, loopIndex] = recorderDump
+    for n in range(_RECORDER_DUMPLINES):
+        if recorderDumpLine == _RECORDER_COUNT:
+            print("looptimes", *[loopTimes[(loopIndex + i) % _RECORDER_LOOPCOUNT] for i in range(_RECORDER_LOOPCOUNT)])
+            recorderDump = 0
+            return
+        offset = _RECORDER_SIZE*((index + recorderDumpLine) % _RECORDER_COUNT)
+        if entries[offset]:
+            print("".join("{:02x}".format(b) for b in entries[offset:offset + 4 + entries[offset + 1]]))
+        recorderDumpLine += 1
+
+
+def checkRecorder():
+    # no commands are observed while the button menu is active
+    if buttonMode != _BUTTON_IDLE or recorderDump:
+        return
+    if not recorderDumped and commandTimestamp.time() > _RECORDER_TIMEOUT:
+        dumpRecorder()
+
+
 def getSpeedCmd(speed, counter):
     buffer = bytearray(pack('<B12h',_CMD_SPEED, 0,0,0, 0,0,0, 0,0,0, 0,0,0))
     pack_into('<h', buffer, 1 + 12*(_HUBID - 5) + 2*(counter + floor(counter/2)), speed)
     return [buffer]
 
 
+def setConfig(data):
+    # returns True if a motor parameter was set
+    global config
+    isMotorConfig = False
+    for i in range(6):
+        param, value = unpack_from('<hh', data, 1 + 4*i)
+        if (param >> 8) in (_HUBID, _CONFIG_ALLHUBS) and (param & 0xff) > 0 and (param & 0xff) < _CONFIG_COUNT:
+            config[param & 0xff] = value
+            if (param & 0xff) >= _CONFIG_SPEEDLIMIT:
+                isMotorConfig = True
+    #print("config is", config)
+    return isMotorConfig
+
+
+def setMotorConfig(m):
+    try:
+        m.control.limits(config[_CONFIG_SPEEDLIMIT], config[_CONFIG_ACCELERATIONLIMIT], config[_CONFIG_TORQUELIMIT])
+        m.control.pid(config[_CONFIG_KP], config[_CONFIG_KI], config[_CONFIG_KD])
+    except:
+        #print("failed to configure motor", m)
+        pass
+
+
 def getMotor(port):
     global motors
     i = _MOTORPORTS.index(port)
@@ -51,6 +178,7 @@ def getMotor(port):
         motors[i].close()
     try:
         motors[i] = Motor(port, reset_angle=False)
+        setMotorConfig(motors[i])
         #print("motor found", port)
     except:
         motors[i] = 0
@@ -64,14 +192,14 @@ def getStatus():
     for i in range(0, 4):
         if motors[i]:
             status += 2**(i+1)
-    if(commandTimestamp.time() < 100):
+    if(commandTimestamp.time() < config[_CONFIG_COMMANDWINDOW]):
         status += 32
     if(buttonMode):
         status += 64
 
 
 def executeCommand(data):
-    global motors, currentCommand, currentChecksum, commandTimestamp
+    global recorderDumped, motors, currentCommand, currentChecksum, commandTimestamp
     checksum = 0
     try:
         command = unpack_from('<B', data[0], 0)[0]
@@ -82,13 +210,17 @@ def executeCommand(data):
         #print("failed to unpack", data)
         return
     commandTimestamp.reset()
+    isNewCommand = not currentCommand or data[0] != currentCommand[0]
+    if isNewCommand:
+        recordEntry(_RECORD_COMMAND, data[0])
+    recorderDumped = False
     currentCommand = data
     currentChecksum = checksum
     #print("command", cmd, mount1, top1, mount2, top2)
     if command == _CMD_KEEPALIVE:
         pass
     elif command == _CMD_SPEED:
-        target = [2*mount1, top1, 2*mount2, top2]
+        target = [config[_CONFIG_SPEEDSCALE]*mount1, top1, config[_CONFIG_SPEEDSCALE]*mount2, top2]
         for i in range(0, 4):
             try:
                 if target[i] == 0:
@@ -113,26 +245,36 @@ def executeCommand(data):
                 getMotor(_MOTORPORTS[i])
     elif command == _CMD_SHUTDOWN:
         hub.system.shutdown()
+    elif command == _CMD_CONFIG and isNewCommand and setConfig(data[0]):
+        for i in range(0, 4):
+            try:
+                motors[i].brake() # limits can only change while the controller is inactive
+                setMotorConfig(motors[i])
+            except:
+                getMotor(_MOTORPORTS[i])
 
 
 def getSensorValues():
-    global motors, imuA, angles
+    global motors, imuA, angles, speeds, loads
     imuA = list(Axis.Z.T*hub.imu.orientation())
     for i in range(0, 4):
         try:
             angles[i] = motors[i].angle()
+            speeds[i] = motors[i].speed()
+            loads[i] = motors[i].load()
             #print("angle is", angles[i])
         except:
             getMotor(_MOTORPORTS[i])
 
 
 
-def getCommand():
+async def getCommand():
     global buttonMode, loopCounter
     #print("button mode is", buttonMode)
     if buttonMode == _BUTTON_IDLE:
         if hub.button.pressed():
             executeCommand(getSpeedCmd(0, 0))
+            dumpRecorder()
             buttonMode = _BUTTON_ACTIVE
         else:
             receive = hub.ble.observe(0)
@@ -169,6 +311,7 @@ def getCommand():
                         counter += 1
                     if buttonMode == _BUTTON_SELECT and not hub.button.pressed():
                         buttonMode = _BUTTON_INACTIVE
+                    await wait(0)
                 executeCommand(getSpeedCmd(speed, counter))
 
             buttonMode = _BUTTON_INACTIVE
@@ -215,18 +358,69 @@ def setLedColor():
     loopCounter = (loopCounter + 1) % 1000
 
 
-def transmitSensorValues():
-    imuV = [0, 0, 0]
-    for j in range(3):
-        imuV[j] = floor(9806.65*imuA[j])
-    data = pack('<BB7h', status, currentChecksum, *imuV, floor(0.1*angles[0]), floor(0.1*angles[1]), floor(0.1*angles[2]), floor(0.1*angles[3]))
+def packBits(buffer, offset, width, value):
+    # signed little endian bit field, saturated to width
+    limit = 1 << (width - 1)
+    value = min(max(value, -limit), limit - 1) & (2*limit - 1)
+    while width > 0:
+        shift = offset & 7
+        n = min(8 - shift, width)
+        buffer[offset >> 3] |= (value & ((1 << n) - 1)) << shift
+        value >>= n
+        offset += n
+        width -= n
+    return offset
+
+
+async def transmitSensorValues():
+    if _FRAMEVERSION == 2:
+        # status, checksum, then bits: version 4, imu 3x12 (5 mm/s^2), base angle 20 (degree),
+        # 3 angle deltas to base 18 (degree), speeds 4x8 (8 degree/s), loads 4x8 (4 mNm)
+        buffer = bytearray(25)
+        buffer[0] = status
+        buffer[1] = currentChecksum
+        offset = packBits(buffer, 16, 4, _FRAMEVERSION)
+        for j in range(3):
+            offset = packBits(buffer, offset, 12, floor(1961.33*imuA[j]))
+        offset = packBits(buffer, offset, 20, angles[0])
+        for i in range(1, 4):
+            offset = packBits(buffer, offset, 18, angles[i] - angles[0])
+        for i in range(4):
+            offset = packBits(buffer, offset, 8, speeds[i] >> 3)
+        for i in range(4):
+            offset = packBits(buffer, offset, 8, loads[i] >> 2)
+        data = bytes(buffer)
+    else:
+        imuV = [0, 0, 0]
+        for j in range(3):
+            imuV[j] = floor(9806.65*imuA[j])
+        data = pack('<BB7h', status, currentChecksum, *imuV, floor(0.1*angles[0]), floor(0.1*angles[1]), floor(0.1*angles[2]), floor(0.1*angles[3]))
     #print("data is", data)
-    hub.ble.broadcast([data])
+    recordFrame(data)
+    await hub.ble.broadcast([data])
+
+
+async def commandTask():
+    while(True):
+        await getCommand()
+        checkRecorder()
+        printRecorder()
+        await wait(0)
+
+
+async def sensorTask():
+    while(True):
+        recordLoopTime()
+        getSensorValues()
+        getStatus()
+        await transmitSensorValues()
+        await wait(config[_CONFIG_LOOPPERIOD])
+
+
+async def lightTask():
+    while(True):
+        setLedColor()
+        await wait(_LIGHT_PERIOD)
 
 
-while(True):
-    getCommand()
-    getSensorValues()
-    getStatus()
-    setLedColor()
-    transmitSensorValues()
+run_task(multitask(commandTask(), sensorTask(), lightTask()))
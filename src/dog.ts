@@ -24,6 +24,8 @@ export class Dog implements DogAbstraction {
 
   _motorAngles: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
   _motorAnglesTimestamps: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
+  _motorSpeeds: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
+  _motorLoads: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
   _topAcceleration: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
   _bottomAcceleration: Vec43 = [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]
   _dogAcceleration: Vec3 = [0,0,0]
@@ -43,6 +45,14 @@ export class Dog implements DogAbstraction {
     return vec43Copy(this._motorAngles);
   }
 
+  get motorSpeeds() {
+    return vec43Copy(this._motorSpeeds);
+  }
+
+  get motorLoads() {
+    return vec43Copy(this._motorLoads);
+  }
+
   get topAcceleration() {
     return vec43Copy(this._topAcceleration);
   }
@@ -216,6 +226,15 @@ export class Dog implements DogAbstraction {
     this.send('notifyDogRotation', 'dog', dogRotationFromMotorAngles(this.motorAngles));
   }
 
+  async notifyMotorSpeeds(motorSpeeds: Vec43, motorLoads: Vec43) {
+    for(let i = 0; i < 4; i++) {
+      for(let j = 0; j < 3; j++) {
+        if(!isNaN(motorSpeeds[i][j])) this._motorSpeeds[i][j] = motorSpeeds[i][j];
+        if(!isNaN(motorLoads[i][j])) this._motorLoads[i][j] = motorLoads[i][j];
+      }
+    }
+  }
+
   async notifyLegAcceleration(topA: Vec43, bottomA: Vec43) {
     for(let i = 0; i < 4; i++) {
       if(topA[i].every(isNaN) && bottomA[i].every(isNaN)) continue;
@@ -23,6 +23,15 @@ const LE_SET_SCAN_RESPONSE_DATA_CMD = OCF_LE_SET_SCAN_RESPONSE_DATA | OGF_LE_CTL
 const LE_SET_ADVERTISING_DATA_CMD = OCF_LE_SET_ADVERTISING_DATA | OGF_LE_CTL << 10;
 const LE_SET_ADVERTISE_ENABLE_CMD = OCF_LE_SET_ADVERTISE_ENABLE | OGF_LE_CTL << 10;
 
+const readBits = (data: Buffer, offset: number, width: number) => {
+  // signed little endian bit field starting at bit offset
+  let value = 0;
+  for(let i = 0; i < width; i++) {
+    value |= ((data[(offset + i) >> 3] >> ((offset + i) & 7)) & 1) << i;
+  }
+  return value & (1 << (width - 1)) ? value - (1 << width) : value;
+}
+
 class Command {
   data: Buffer
   promise: Promise<any>
@@ -56,34 +65,115 @@ export class PybricksCommander implements CommanderAbstraction {
 
   async onData(data: Buffer) {
     // console.log(data);
-    if(data.length < 35) return;
+    if(data.length < 34) return;
     if(data.readUInt8(15) != 0xff) return; // manufacturer data
     if(data.readUInt16LE(16) != 0x0397) return; // lego
     const id = data.readUInt8(18);
+    if(id == 0 && data.readUInt8(19) == 0xd2) return this.onRelayData(data); // combined state from control hub
     if(id < 1 || id > 6) return;
-    if(id < 5 && data.readUInt8(19) != 0xd2) return;
-    if(id > 4 && data.readUInt8(19) != 0xd0) return;
+    const type = data.readUInt8(19);
+    const fused = (id < 5 && type == 0xcf); // leg angles computed on hub
+    const packed = (id < 5 && type == 0xd1) || (id > 4 && type == 0xd9); // bit packed frame version 2
+    if(!fused && data.length < 35) return;
+    if(id < 5 && !fused && !packed && type != 0xd2) return;
+    if(id > 4 && !packed && type != 0xd0) return;
+    if(packed && (data.readUInt8(22) & 0x0f) != 2) return;
     this.currentChecksums[id - 1] = data.readUInt8(21);
     if(this.currentCommand && this.currentChecksums[id -1] == this.currentCommand.checksum) {
       this.dog.notifyHubStatus(id - 1, data.readUInt8(20), Date.now(), data.readInt8(data.length - 1));
     }
-    if(id == 5) this.dog.notifyDogAcceleration([-data.readInt16LE(22), data.readInt16LE(26), -data.readInt16LE(24)]); // [-x, z, -y]
     const motorAngles = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
+    const motorSpeeds = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
+    const motorLoads = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
     const topA = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
     const bottomA = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
-    if(id < 5) {
+    if(packed) {
+      // bit offsets from status byte: version 16, imu 20 (3x12, 5 mm/s^2), base angle 56 (20, degree)
+      const bits = (offset: number, width: number) => readBits(data, 160 + offset, width);
+      const imu = [5*bits(20, 12), 5*bits(32, 12), 5*bits(44, 12)];
+      if(id < 5) {
+        // speed 76 (8, 8 degree/s), load 84 (8, 4 mNm), tilt 92 (3x12, 5 mm/s^2), distance 128 (8)
+        topA[id - 1] = [-imu[0], imu[2], -imu[1]];
+        bottomA[id - 1] = [5*bits(104, 12), 5*bits(92, 12), 5*bits(116, 12)];
+        motorAngles[id - 1][2] = bits(56, 20);
+        motorSpeeds[id - 1][2] = 8*bits(76, 8);
+        motorLoads[id - 1][2] = 4*bits(84, 8);
+        this.dog.notifyLegAcceleration(topA, bottomA);
+      }
+      else {
+        // angle deltas to base 76 (3x18, degree), speeds 130 (4x8, 8 degree/s), loads 162 (4x8, 4 mNm)
+        if(id == 5) this.dog.notifyDogAcceleration([-imu[0], imu[2], -imu[1]]); // [-x, z, -y]
+        const base = bits(56, 20);
+        for(let i = 0; i < 4; i++) {
+          const leg = 2*(id - 5) + (i >> 1);
+          motorAngles[leg][i & 1] = i == 0 ? base : base + bits(58 + 18*i, 18);
+          motorSpeeds[leg][i & 1] = 8*bits(130 + 8*i, 8);
+          motorLoads[leg][i & 1] = 4*bits(162 + 8*i, 8);
+        }
+      }
+      this.dog.notifyMotorSpeeds(motorSpeeds, motorLoads);
+    }
+    else if(fused) {
+      const mount = data.readInt16LE(22)/10000;
+      const top = data.readInt16LE(24)/10000;
+      const bottom = data.readInt16LE(26)/10000;
+      const bottomElevation = data.readInt16LE(28)/10000;
+      topA[id - 1] = [9806.65*Math.cos(mount)*Math.cos(top), 9806.65*Math.sin(mount), 9806.65*Math.cos(mount)*Math.sin(top)];
+      if(data.readUInt8(30) > 0) { // confidence of lower leg angles
+        bottomA[id - 1] = [9806.65*Math.cos(bottomElevation)*Math.cos(bottom), 9806.65*Math.sin(bottomElevation), 9806.65*Math.cos(bottomElevation)*Math.sin(bottom)];
+      }
+      motorAngles[id - 1][2] = 10*data.readInt16LE(31);
+      this.dog.notifyLegAcceleration(topA, bottomA);
+    }
+    else if(id < 5) {
       topA[id - 1] = [-data.readInt16LE(22), data.readInt16LE(26), -data.readInt16LE(24)];
       motorAngles[id - 1][2] = 10*data.readInt16LE(28);
       bottomA[id - 1] = [data.readInt16LE(32), data.readInt16LE(30), data.readInt16LE(34)];
       this.dog.notifyLegAcceleration(topA, bottomA);
     }
     else {
+      if(id == 5) this.dog.notifyDogAcceleration([-data.readInt16LE(22), data.readInt16LE(26), -data.readInt16LE(24)]); // [-x, z, -y]
       motorAngles[2*(id - 5)][0] = 10*data.readInt16LE(28);
       motorAngles[2*(id - 5)][1] = 10*data.readInt16LE(30);
       motorAngles[2*(id - 5) + 1][0] = 10*data.readInt16LE(32);
       motorAngles[2*(id - 5) + 1][1] = 10*data.readInt16LE(34);
     }
     this.dog.notifyMotorAngles(motorAngles);
+    this.checkCommandDone();
+  }
+
+  onRelayData(data: Buffer) {
+    const checksum = data.readUInt8(21);
+    const motorAngles = [[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN],[NaN,NaN,NaN]] as Vec43
+    const frame = data.readUInt8(20);
+    if(frame == 0) { // ack mask, hub status, leg motor angles
+      const ackmask = data.readUInt8(22);
+      for(let i = 0; i < 6; i++) {
+        if(!(ackmask & (1 << i))) continue;
+        this.currentChecksums[i] = checksum;
+        if(this.currentCommand && checksum == this.currentCommand.checksum) {
+          this.dog.notifyHubStatus(i, data.readUInt8(24 + i), Date.now(), data.readInt8(data.length - 1));
+        }
+      }
+      for(let i = 0; i < 4; i++) {
+        motorAngles[i][2] = 10*data.readInt16LE(30 + 2*i);
+      }
+    }
+    else if(frame == 1) { // middle hub motor angles
+      for(let i = 0; i < 8; i++) {
+        motorAngles[i >> 1][i & 1] = 10*data.readInt16LE(22 + 2*i);
+      }
+    }
+    else if(frame == 2) { // middle hub acceleration
+      this.dog.notifyDogAcceleration([-data.readInt16LE(22), data.readInt16LE(26), -data.readInt16LE(24)]); // [-x, z, -y]
+      return;
+    }
+    else return;
+    this.dog.notifyMotorAngles(motorAngles);
+    this.checkCommandDone();
+  }
+
+  checkCommandDone() {
     if(this.currentCommand && this.currentChecksums.every(e => e == this.currentCommand.checksum)) {
       if(this.currentCommand.data[1] != 2 || this.dog.motorAngles.every((e,i) => e.every((f,j) => Math.abs(f - 10*this.currentCommand.data.readInt16LE(2 + 6*i + 2*j)) < 200.0))) {
         // not requestMotorAngles command or motorAngles reached destination
@@ -240,6 +330,16 @@ export class PybricksCommander implements CommanderAbstraction {
     return this.sendCommand(4, [[0,0,0], [0,0,0], [0,0,0], [0,0,0]]);
   }
 
+  async requestConfig (params: [number, number, number][]) {
+    // [hub (7 -> all hubs), parameter index, value], at most six per command
+    const data = [0,0,0,0,0,0,0,0,0,0,0,0];
+    params.slice(0, 6).forEach(([hub, index, value], i) => {
+      data[2*i] = (hub << 8) | index;
+      data[2*i + 1] = value;
+    });
+    return this.sendCommand(5, [data.slice(0, 3), data.slice(3, 6), data.slice(6, 9), data.slice(9, 12)] as Vec43);
+  }
+
   async requestMotorSpeeds (motorSpeeds: Vec43) {
     // console.log("requesting speed with", motorSpeeds);
     return this.sendCommand(1, motorSpeeds);
@@ -4,6 +4,8 @@ export interface SensorAbstraction {
   readonly hubStatus: number[]
 
   readonly motorAngles: Vec43
+  readonly motorSpeeds: Vec43
+  readonly motorLoads: Vec43
   readonly topAcceleration: Vec43
   readonly bottomAcceleration: Vec43
   readonly dogAcceleration: Vec3
@@ -11,6 +13,7 @@ export interface SensorAbstraction {
   notifyHubStatus: (hubId: number, status: number, timestamp: number, rssi: number) => Promise<void>;
 
   notifyMotorAngles: (motorAngles: Vec43) => Promise<void>;
+  notifyMotorSpeeds: (motorSpeeds: Vec43, motorLoads: Vec43) => Promise<void>;
   notifyLegAcceleration: (topA: Vec43, bottomA) => Promise<void>;
   notifyDogAcceleration: (acceleration: Vec3) => Promise<void>;
 }
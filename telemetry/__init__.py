@@ -0,0 +1,4 @@
+from .frames import RECORD_DTYPE, LEG_DTYPE, FUSED_DTYPE, MIDDLE_DTYPE, COMMAND_DTYPE, decodeFrames
+from .log import Recorder, readLog, writeLog
+from .capture import parseAdvertisement, parseManufacturerData, simulate, captureBleak
+from .replay import replay
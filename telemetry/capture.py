@@ -0,0 +1,107 @@
+import numpy as np
+
+from .frames import RECORD_DTYPE, _LEG_RAW, _MIDDLE_RAW, _TYPE_LEG, _TYPE_LEG_PACKED, _TYPE_MIDDLE, _TYPE_MIDDLE_PACKED, _packBits
+
+
+_LEGO = 0x0397
+
+
+def parseManufacturerData(data):
+    """Split lego manufacturer data without company id into (channel, type, payload)."""
+    if len(data) < 2:
+        return None
+    channel = data[0]
+    valueType = data[1]
+    payload = bytes(data[2:2 + (valueType & 0x1f)])
+    return channel, valueType, payload
+
+
+def parseAdvertisement(data):
+    """Parse a raw hci le advertising report as received by PybricksCommander.onData."""
+    if len(data) < 21:
+        return None
+    if data[15] != 0xff: # manufacturer data
+        return None
+    if int.from_bytes(data[16:18], 'little') != _LEGO:
+        return None
+    parsed = parseManufacturerData(data[18:-1])
+    if parsed is None:
+        return None
+    rssi = int.from_bytes(data[-1:], 'little', signed=True)
+    return parsed + (rssi,)
+
+
+async def captureBleak(recorder, duration):
+    """Record pybricks broadcasts with bleak for duration seconds."""
+    import asyncio
+    from bleak import BleakScanner
+
+    def onAdvertisement(device, advertisement):
+        data = advertisement.manufacturer_data.get(_LEGO)
+        parsed = parseManufacturerData(data) if data else None
+        if parsed:
+            recorder.record(*parsed, rssi=advertisement.rssi)
+
+    async with BleakScanner(onAdvertisement):
+        await asyncio.sleep(duration)
+    recorder.flush()
+
+
+def simulate(count, period=0.1, seed=None, version=1):
+    """Generate count records of standing robot telemetry, hubs 1 to 6 in turn, in frame version 1 or 2."""
+    rng = np.random.default_rng(seed)
+    records = np.zeros(count, RECORD_DTYPE)
+    records['channel'] = 1 + np.arange(count) % 6
+    records['time'] = np.arange(count)*(1e6*period/6)
+    records['rssi'] = rng.integers(-80, 0, count)
+    leg = records['channel'] <= 4
+    middle = ~leg
+
+    legRaw = np.zeros(np.count_nonzero(leg), _LEG_RAW)
+    legRaw['status'] = 0b00100111
+    legRaw['imu'] = [9807, 0, 0] + rng.normal(0, 50, (len(legRaw), 3))
+    legRaw['angle'] = np.cumsum(rng.integers(-1, 2, len(legRaw)))
+    legRaw['tilt'] = [0, -9807, 0] + rng.normal(0, 200, (len(legRaw), 3))
+    if version == 2:
+        bits = np.zeros((len(legRaw), 136), 'u1')
+        offset = _packBits(bits, 16, 4, np.full(len(legRaw), 2))
+        for j in range(3):
+            offset = _packBits(bits, offset, 12, legRaw['imu'][:, j]/5)
+        offset = _packBits(bits, offset, 20, 10*legRaw['angle'])
+        offset = _packBits(bits, offset, 8, rng.normal(0, 16, len(legRaw))/8)
+        offset = _packBits(bits, offset, 8, rng.normal(0, 20, len(legRaw))/4)
+        for j in range(3):
+            offset = _packBits(bits, offset, 12, legRaw['tilt'][:, j]/5)
+        _packBits(bits, offset, 8, legRaw['distance'])
+        payload = np.packbits(bits, axis=1, bitorder='little')
+        payload[:, 0] = legRaw['status']
+        records['type'][leg] = _TYPE_LEG_PACKED
+        records['payload'][leg, :payload.shape[1]] = payload
+    else:
+        records['type'][leg] = _TYPE_LEG
+        records['payload'][leg, :_LEG_RAW.itemsize] = legRaw.view('u1').reshape(-1, _LEG_RAW.itemsize)
+
+    middleRaw = np.zeros(np.count_nonzero(middle), _MIDDLE_RAW)
+    middleRaw['status'] = 0b00111111
+    middleRaw['imu'] = [0, 0, 9807] + rng.normal(0, 50, (len(middleRaw), 3))
+    middleRaw['angles'] = np.cumsum(rng.integers(-1, 2, (len(middleRaw), 4)), axis=0)
+    if version == 2:
+        bits = np.zeros((len(middleRaw), 200), 'u1')
+        offset = _packBits(bits, 16, 4, np.full(len(middleRaw), 2))
+        for j in range(3):
+            offset = _packBits(bits, offset, 12, middleRaw['imu'][:, j]/5)
+        offset = _packBits(bits, offset, 20, 10*middleRaw['angles'][:, 0])
+        for j in range(1, 4):
+            offset = _packBits(bits, offset, 18, 10*(middleRaw['angles'][:, j] - middleRaw['angles'][:, 0]))
+        for j in range(4):
+            offset = _packBits(bits, offset, 8, rng.normal(0, 16, len(middleRaw))/8)
+        for j in range(4):
+            offset = _packBits(bits, offset, 8, rng.normal(0, 20, len(middleRaw))/4)
+        payload = np.packbits(bits, axis=1, bitorder='little')
+        payload[:, 0] = middleRaw['status']
+        records['type'][middle] = _TYPE_MIDDLE_PACKED
+        records['payload'][middle, :payload.shape[1]] = payload
+    else:
+        records['type'][middle] = _TYPE_MIDDLE
+        records['payload'][middle, :_MIDDLE_RAW.itemsize] = middleRaw.view('u1').reshape(-1, _MIDDLE_RAW.itemsize)
+    return records
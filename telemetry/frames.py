@@ -0,0 +1,201 @@
+import numpy as np
+
+
+# pybricks broadcast value header: type 6 (bytes) << 5 | length
+_TYPE_LEG = 0xd2 # legHub '<BB8h'
+_TYPE_LEG_PACKED = 0xd1 # legHub bit packed frame version 2
+_TYPE_FUSED = 0xcf # legHub '<BB4hBhh' with _SENSORFUSION
+_TYPE_MIDDLE = 0xd0 # middleHub '<BB7h'
+_TYPE_MIDDLE_PACKED = 0xd9 # middleHub bit packed frame version 2
+_TYPE_COMMAND = 0xd9 # controlHub or pc '<B12h'
+
+_PAYLOADSIZE = 25
+
+# one observed advertisement, as stored in the log file
+RECORD_DTYPE = np.dtype([
+    ('time', '<u8'), # microseconds
+    ('channel', 'u1'),
+    ('type', 'u1'),
+    ('rssi', 'i1'),
+    ('payload', 'u1', (_PAYLOADSIZE,)),
+])
+
+# packed layouts as sent by the hubs
+_LEG_RAW = np.dtype([
+    ('status', 'u1'),
+    ('checksum', 'u1'),
+    ('imu', '<i2', (3,)),
+    ('angle', '<i2'),
+    ('tilt', '<i2', (3,)),
+    ('distance', '<i2'),
+])
+_FUSED_RAW = np.dtype([
+    ('status', 'u1'),
+    ('checksum', 'u1'),
+    ('legAngles', '<i2', (4,)),
+    ('confidence', 'u1'),
+    ('angle', '<i2'),
+    ('distance', '<i2'),
+])
+_MIDDLE_RAW = np.dtype([
+    ('status', 'u1'),
+    ('checksum', 'u1'),
+    ('imu', '<i2', (3,)),
+    ('angles', '<i2', (4,)),
+])
+_COMMAND_RAW = np.dtype([
+    ('command', 'u1'),
+    ('targets', '<i2', (4, 3)),
+])
+
+# decoded frames, accelerations in mm/s^2, motor angles in degree, leg angles in rad
+_HEADER = [('time', '<f8'), ('hub', 'u1'), ('rssi', 'i1'), ('status', 'u1'), ('checksum', 'u1')]
+LEG_DTYPE = np.dtype(_HEADER + [
+    ('imu', '<f4', (3,)),
+    ('angle', '<f4'),
+    ('tilt', '<f4', (3,)),
+    ('distance', '<i2'),
+    ('speed', '<f4'), # degree/s, NaN in frame version 1
+    ('load', '<f4'), # mNm, NaN in frame version 1
+])
+FUSED_DTYPE = np.dtype(_HEADER + [
+    ('legAngles', '<f4', (4,)), # mount elevation, upper leg, lower leg, lower leg elevation
+    ('confidence', '<f4'),
+    ('angle', '<f4'),
+    ('distance', '<i2'),
+])
+MIDDLE_DTYPE = np.dtype(_HEADER + [
+    ('imu', '<f4', (3,)),
+    ('angles', '<f4', (4,)),
+    ('speeds', '<f4', (4,)),
+    ('loads', '<f4', (4,)),
+])
+COMMAND_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('command', 'u1'),
+    ('targets', '<i2', (4, 3)),
+])
+
+
+def _select(records, mask, rawDtype):
+    selected = records[mask]
+    payload = np.ascontiguousarray(selected['payload'][:, :rawDtype.itemsize])
+    return selected, payload.view(rawDtype).reshape(-1)
+
+
+def _header(selected, raw, dtype):
+    frames = np.empty(len(selected), dtype)
+    frames['time'] = 1e-6*selected['time']
+    frames['hub'] = selected['channel']
+    frames['rssi'] = selected['rssi']
+    frames['status'] = raw['status']
+    frames['checksum'] = raw['checksum']
+    return frames
+
+
+def _selectPacked(records, mask):
+    selected = records[mask]
+    bits = np.unpackbits(selected['payload'], axis=1, bitorder='little')
+    version = _unpackBits(bits, 16, 4) == 2
+    selected, bits = selected[version], bits[version]
+    raw = {'status': selected['payload'][:, 0], 'checksum': selected['payload'][:, 1]}
+    return selected, raw, bits
+
+
+def _unpackBits(bits, offset, width):
+    # signed little endian bit field of every row
+    value = bits[:, offset:offset + width].astype(np.int32) @ (1 << np.arange(width, dtype=np.int32))
+    return np.where(value >= 1 << (width - 1), value - (1 << width), value)
+
+
+def _packBits(bits, offset, width, values):
+    # signed little endian bit field of every row, saturated to width as on the hubs
+    limit = 1 << (width - 1)
+    values = np.clip(np.rint(values), -limit, limit - 1).astype(np.int32) & (2*limit - 1)
+    bits[:, offset:offset + width] = (values[:, None] >> np.arange(width)) & 1
+    return offset + width
+
+
+def _sortByTime(*frames):
+    frames = np.concatenate(frames)
+    return frames[np.argsort(frames['time'], kind='stable')]
+
+
+def decodeLeg(records):
+    mask = (records['channel'] >= 1) & (records['channel'] <= 4) & (records['type'] == _TYPE_LEG)
+    selected, raw = _select(records, mask, _LEG_RAW)
+    frames = _header(selected, raw, LEG_DTYPE)
+    frames['imu'] = raw['imu']
+    frames['angle'] = 10*raw['angle'].astype(np.float32)
+    frames['tilt'] = raw['tilt']
+    frames['distance'] = raw['distance']
+    frames['speed'] = np.nan
+    frames['load'] = np.nan
+    return _sortByTime(frames, decodePackedLeg(records))
+
+
+def decodePackedLeg(records):
+    mask = (records['channel'] >= 1) & (records['channel'] <= 4) & (records['type'] == _TYPE_LEG_PACKED)
+    selected, raw, bits = _selectPacked(records, mask)
+    frames = _header(selected, raw, LEG_DTYPE)
+    frames['imu'] = 5*np.stack([_unpackBits(bits, 20 + 12*j, 12) for j in range(3)], axis=1)
+    frames['angle'] = _unpackBits(bits, 56, 20)
+    frames['speed'] = 8*_unpackBits(bits, 76, 8)
+    frames['load'] = 4*_unpackBits(bits, 84, 8)
+    frames['tilt'] = 5*np.stack([_unpackBits(bits, 92 + 12*j, 12) for j in range(3)], axis=1)
+    frames['distance'] = _unpackBits(bits, 128, 8)
+    return frames
+
+
+def decodeFused(records):
+    mask = (records['channel'] >= 1) & (records['channel'] <= 4) & (records['type'] == _TYPE_FUSED)
+    selected, raw = _select(records, mask, _FUSED_RAW)
+    frames = _header(selected, raw, FUSED_DTYPE)
+    frames['legAngles'] = 1e-4*raw['legAngles'].astype(np.float32)
+    frames['confidence'] = raw['confidence']/np.float32(255)
+    frames['angle'] = 10*raw['angle'].astype(np.float32)
+    frames['distance'] = raw['distance']
+    return frames
+
+
+def decodeMiddle(records):
+    mask = (records['channel'] >= 5) & (records['channel'] <= 6) & (records['type'] == _TYPE_MIDDLE)
+    selected, raw = _select(records, mask, _MIDDLE_RAW)
+    frames = _header(selected, raw, MIDDLE_DTYPE)
+    frames['imu'] = raw['imu']
+    frames['angles'] = 10*raw['angles'].astype(np.float32)
+    frames['speeds'] = np.nan
+    frames['loads'] = np.nan
+    return _sortByTime(frames, decodePackedMiddle(records))
+
+
+def decodePackedMiddle(records):
+    mask = (records['channel'] >= 5) & (records['channel'] <= 6) & (records['type'] == _TYPE_MIDDLE_PACKED)
+    selected, raw, bits = _selectPacked(records, mask)
+    frames = _header(selected, raw, MIDDLE_DTYPE)
+    frames['imu'] = 5*np.stack([_unpackBits(bits, 20 + 12*j, 12) for j in range(3)], axis=1)
+    base = _unpackBits(bits, 56, 20)
+    frames['angles'] = np.stack([base] + [base + _unpackBits(bits, 58 + 18*j, 18) for j in range(1, 4)], axis=1)
+    frames['speeds'] = 8*np.stack([_unpackBits(bits, 130 + 8*j, 8) for j in range(4)], axis=1)
+    frames['loads'] = 4*np.stack([_unpackBits(bits, 162 + 8*j, 8) for j in range(4)], axis=1)
+    return frames
+
+
+def decodeCommand(records):
+    mask = (records['channel'] == 0) & (records['type'] == _TYPE_COMMAND)
+    selected, raw = _select(records, mask, _COMMAND_RAW)
+    frames = np.empty(len(selected), COMMAND_DTYPE)
+    frames['time'] = 1e-6*selected['time']
+    frames['command'] = raw['command']
+    frames['targets'] = raw['targets']
+    return frames
+
+
+def decodeFrames(records):
+    """Decode log records into structured arrays, one per frame layout."""
+    return {
+        'leg': decodeLeg(records),
+        'fused': decodeFused(records),
+        'middle': decodeMiddle(records),
+        'command': decodeCommand(records),
+    }
@@ -0,0 +1,71 @@
+import time
+import numpy as np
+
+from .frames import RECORD_DTYPE
+
+
+_MAGIC = b'BBTL\x01' # babyele telemetry log, version 1
+
+
+class Recorder:
+    """Append advertisements to a binary log file in fixed size records."""
+    def __init__(self, path, chunkSize=4096):
+        self.file = open(path, 'wb')
+        self.file.write(_MAGIC)
+        self.buffer = np.zeros(chunkSize, RECORD_DTYPE)
+        self.count = 0
+        self.startTime = time.monotonic_ns()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, channel, valueType, payload, rssi=0, timestamp=None):
+        if timestamp is None:
+            timestamp = (time.monotonic_ns() - self.startTime)//1000
+        i = self.count
+        self.buffer['time'][i] = timestamp
+        self.buffer['channel'][i] = channel
+        self.buffer['type'][i] = valueType
+        self.buffer['rssi'][i] = rssi
+        row = self.buffer['payload'][i]
+        payload = np.frombuffer(bytes(payload), 'u1')[:len(row)]
+        row[:] = 0
+        row[:len(payload)] = payload
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def recordMany(self, records):
+        self.flush()
+        np.asarray(records, RECORD_DTYPE).tofile(self.file)
+
+    def flush(self):
+        self.buffer[:self.count].tofile(self.file)
+        self.count = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+def writeLog(path, records):
+    with Recorder(path) as recorder:
+        recorder.recordMany(records)
+
+
+def readLog(path, mmap=True):
+    """Return the records of a log file, memory mapped unless mmap is False."""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("not a telemetry log: " + str(path))
+        if not mmap:
+            return np.fromfile(f, RECORD_DTYPE)
+        if f.read(1) == b'':
+            return np.zeros(0, RECORD_DTYPE)
+    return np.memmap(path, RECORD_DTYPE, mode='r', offset=len(_MAGIC))
@@ -0,0 +1,15 @@
+import time
+
+
+def replay(records, speed=1.0, sleep=time.sleep):
+    """Yield records paced by their timestamps, speed 0 replays without delay."""
+    if len(records) == 0:
+        return
+    startTime = time.monotonic()
+    firstTimestamp = int(records['time'][0])
+    for record in records:
+        if speed > 0:
+            delay = 1e-6*(int(record['time']) - firstTimestamp)/speed - (time.monotonic() - startTime)
+            if delay > 0:
+                sleep(delay)
+        yield record